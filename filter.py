@@ -20,6 +20,7 @@ import gc
 import multiprocessing
 from functools import partial
 from sklearn.preprocessing import MultiLabelBinarizer
+from loaders import load_kg, downcast_counts
 
 
 # Data paths (This was programmed on a Windows machine, adjust as needed)
@@ -54,24 +55,23 @@ console.setFormatter(formatter)
 logging.getLogger('').addHandler(console)
 
 # Load the knowledge graph
-kg = nx.read_gml(kg_path)
+kg = load_kg(kg_path)
 logging.info(f"Loaded KG with {kg.number_of_nodes()} nodes and {kg.number_of_edges()} edges")
-node_types = nx.get_node_attributes(kg, 'type')
-gene_protein_nodes = [node for node, typ in node_types.items() if typ and typ.lower() == 'gene/protein']
-disease_nodes = [node for node, typ in node_types.items() if typ and typ.lower() == 'disease']
+node_types = pd.Series(nx.get_node_attributes(kg, 'type'), dtype=object)
+node_types_lower = node_types.str.lower()
+gene_protein_nodes = node_types.index[node_types_lower == 'gene/protein'].tolist()
+disease_nodes = node_types.index[node_types_lower == 'disease'].tolist()
 logging.info(f"KG contains {len(gene_protein_nodes)} gene/protein nodes and {len(disease_nodes)} disease nodes.")
 
 # Extract and clean ICD-10 codes from the KG
-kg_icd10_codes = [
-    node for node, attrs in kg.nodes(data=True)
-    if attrs.get('type') == 'disease' and node[0].isalpha()
-]
+icd10_mask = (node_types == 'disease') & node_types.index.str[0].str.isalpha()
+kg_icd10_codes = node_types.index[icd10_mask].tolist()
 kg_icd10_codes_clean = [code.replace('.', '') for code in kg_icd10_codes]
 icd10_mapping = {code.replace('.', ''): code for code in kg_icd10_codes}
 logging.info(f"Extracted {len(kg_icd10_codes_clean)} ICD10 codes from KG")
 
 try:
-    icd_df = pd.read_csv(filtered_icd_matrix_path)
+    icd_df = downcast_counts(pd.read_csv(filtered_icd_matrix_path, dtype={'PMBB_ID': 'string[pyarrow]'}))
     logging.info(f"Loaded Filtered ICD Matrix with shape {icd_df.shape}.")
 except Exception as e:
     logging.error(f"Error loading Filtered ICD Matrix: {e}")
@@ -79,6 +79,7 @@ except Exception as e:
 
 try:
     variant_df = pd.read_csv(pathogenic_variant_matrix_path)
+    variant_df = downcast_counts(variant_df, id_column=variant_df.columns[0])
     logging.info(f"Loaded Pathogenic Variant Matrix shape {variant_df.shape}.")
     logging.debug(f"Pathogenic Variant Matrix columns: {list(variant_df.columns[:5])} ...")
     logging.debug(f"Sample Variant data:\n{variant_df.head()}")
@@ -99,7 +100,8 @@ except Exception as e:
 icd_df.columns = [col.replace('.', '') for col in icd_df.columns]
 
 # Filter ICD-10 codes to include only those present in the KG
-filtered_icd10_codes = [icd10_mapping[code] for code in kg_icd10_codes_clean if code in icd_df.columns]
+common_icd10_codes = pd.Index(kg_icd10_codes_clean).intersection(icd_df.columns)
+filtered_icd10_codes = [icd10_mapping[code] for code in common_icd10_codes]
 filtered_icd_df = icd_df[['PMBB_ID'] + filtered_icd10_codes]
 
 output_path = 'C:/bmin520/patients_filtered_new/filtered_icd10_kg.csv'
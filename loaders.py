@@ -0,0 +1,42 @@
+import os
+import pickle
+import tempfile
+from contextlib import suppress
+import networkx as nx
+import pandas as pd
+
+
+# Write a file through a temporary file in the same directory and move it into place, so readers never see a partial file
+def atomic_write(path: str, write) -> None:
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with suppress(OSError):
+            os.remove(tmp_path)
+        raise
+
+
+# Load a GML knowledge graph, caching the parsed graph as a pickle next to the GML file
+# An unreadable cache counts as a miss, and a cache that cannot be written (e.g. read-only directory) is skipped
+def load_kg(kg_path: str) -> nx.Graph:
+    cache_path = kg_path + '.pkl'
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(kg_path):
+        try:
+            with open(cache_path, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            pass
+    kg = nx.read_gml(kg_path)
+    with suppress(OSError):
+        atomic_write(cache_path, lambda f: pickle.dump(kg, f, protocol=pickle.HIGHEST_PROTOCOL))
+    return kg
+
+
+# Fill NaNs with 0 and downcast the count columns of a patient matrix to the smallest integer dtype that holds them
+def downcast_counts(df: pd.DataFrame, id_column: str = 'PMBB_ID') -> pd.DataFrame:
+    count_columns = df.columns.drop(id_column)
+    df[count_columns] = df[count_columns].fillna(0).apply(pd.to_numeric, downcast='integer')
+    return df
@@ -1,19 +1,82 @@
 import os
 import networkx as nx
 import torch
-from torch_geometric.nn import Node2Vec
+import torch.nn.functional as F
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from numba import njit, prange
 from sklearn.linear_model import LogisticRegression
 from sklearn.model_selection import train_test_split
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
 from sklearn.metrics import precision_score, recall_score, f1_score, accuracy_score
 import joblib
+from loaders import load_kg
+
+
+# Second-order node2vec walks over a CSR adjacency (rejection sampling on the p/q bias)
+@njit(parallel=True)
+def _node2vec_walks(indptr, indices, start, walk_length, p, q):
+    walks = np.empty((start.shape[0], walk_length + 1), dtype=np.int64)
+    max_weight = max(1.0 / p, 1.0, 1.0 / q)
+    uniform = p == 1.0 and q == 1.0
+    for i in prange(start.shape[0]):
+        walks[i, 0] = start[i]
+        for step in range(1, walk_length + 1):
+            cur = walks[i, step - 1]
+            deg = indptr[cur + 1] - indptr[cur]
+            if deg == 0:
+                walks[i, step] = cur
+                continue
+            if step == 1 or uniform:
+                walks[i, step] = indices[indptr[cur] + np.random.randint(deg)]
+                continue
+            prev = walks[i, step - 2]
+            prev_neighbors = indices[indptr[prev]:indptr[prev + 1]]
+            while True:
+                nxt = indices[indptr[cur] + np.random.randint(deg)]
+                if nxt == prev:
+                    weight = 1.0 / p
+                else:
+                    pos = np.searchsorted(prev_neighbors, nxt)
+                    if pos < prev_neighbors.shape[0] and prev_neighbors[pos] == nxt:
+                        weight = 1.0
+                    else:
+                        weight = 1.0 / q
+                if np.random.random() * max_weight < weight:
+                    break
+            walks[i, step] = nxt
+    return walks
+
+
+# Split walks into the overlapping context windows used by the skip-gram loss
+def _context_windows(rw, context_size):
+    num_windows = rw.size(1) + 1 - context_size
+    return torch.cat([rw[:, j:j + context_size] for j in range(num_windows)], dim=0)
+
+
+# Dot products between the first node of each window and the rest of the window
+def _window_scores(weight, rw):
+    h = F.embedding(rw, weight, sparse=True)
+    return torch.bmm(h[:, 1:], h[:, 0].unsqueeze(-1)).squeeze(-1)
+
+
+# Skip-gram negative-sampling loss over positive and negative context windows
+def _skipgram_loss(weight, pos_rw, neg_rw):
+    pos_loss = -F.logsigmoid(_window_scores(weight, pos_rw)).mean()
+    neg_loss = -F.logsigmoid(-_window_scores(weight, neg_rw)).mean()
+    return pos_loss + neg_loss
+
 
 class NodeEmbeddingPredictor:
     def __init__(self, kg_path, icd_matrix_path, variant_matrix_path):
-        self.kg = nx.read_gml(kg_path)
+        self.kg = load_kg(kg_path)
         self.filtered_icd_df = pd.read_csv(icd_matrix_path)
-        self.variant_df = pd.read_csv(variant_matrix_path, index_col=0)
+        variant_df = pd.read_csv(variant_matrix_path, index_col=0)
+        self.variant_patients = variant_df.index
+        self.variant_genes = variant_df.columns
+        self.variant_matrix = sp.csr_matrix(variant_df.to_numpy())
 
     def create_node_mapping(self):
         self.node_list = list(self.kg.nodes())
@@ -21,42 +84,49 @@ class NodeEmbeddingPredictor:
         self.id_to_node = {idx: node for node, idx in self.node_to_id.items()}
 
     def prepare_edge_index(self):
-        edge_index = []
-        for edge in self.kg.edges():
-            edge_index.append([self.node_to_id[edge[0]], self.node_to_id[edge[1]]])
-            edge_index.append([self.node_to_id[edge[1]], self.node_to_id[edge[0]]])
-        self.edge_index_tensor = torch.tensor(edge_index, dtype=torch.long).t().contiguous()
+        # KG is stored as a directed GML, so add the reverse of every edge
+        adjacency = nx.to_scipy_sparse_array(self.kg, nodelist=self.node_list, format='coo')
+        row = adjacency.row.astype(np.int64)
+        col = adjacency.col.astype(np.int64)
+        edge_index = np.stack([np.concatenate([row, col]), np.concatenate([col, row])])
+        self.edge_index_tensor = torch.from_numpy(edge_index).contiguous()
 
-    def train_node_embeddings(self, embedding_dim=128):
+    def train_node_embeddings(self, embedding_dim=128, walk_length=50, context_size=20, walks_per_node=40, p=0.5, q=2, batch_size=64):
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        node2vec = Node2Vec(
-            self.edge_index_tensor,
-            embedding_dim=embedding_dim,
-            walk_length=50,
-            context_size=20,
-            walks_per_node=40,
-            p=0.5,
-            q=2,
-            sparse=True
-        ).to(device)
-
-        loader = node2vec.loader(batch_size=64, shuffle=True, num_workers=0)
-        optimizer = torch.optim.SparseAdam(list(node2vec.parameters()), lr=0.005)
+        num_nodes = len(self.node_list)
+        embedding = torch.nn.Embedding(num_nodes, embedding_dim, sparse=True).to(device)
+
+        row, col = self.edge_index_tensor.numpy()
+        adjacency = sp.csr_matrix((np.ones(row.shape[0], dtype=np.float32), (row, col)), shape=(num_nodes, num_nodes))
+        adjacency.sum_duplicates()
+        indptr = adjacency.indptr.astype(np.int64)
+        indices = adjacency.indices.astype(np.int64)
+
+        optimizer = torch.optim.SparseAdam([embedding.weight], lr=0.005)
 
         os.environ['PYTORCH_CUDA_ALLOC_CONF'] = 'expandable_segments:True'
         torch.cuda.empty_cache()
 
+        self.epoch_losses = []
         for epoch in range(1, 51):
-            node2vec.train()
-            total_loss = 0
-            for pos_rw, neg_rw in loader:
-                optimizer.zero_grad()
-                loss = node2vec.loss(pos_rw.to(device), neg_rw.to(device))
+            total_loss = torch.zeros((), device=device)
+            for batch in torch.randperm(num_nodes).split(batch_size):
+                start = batch.repeat(walks_per_node).numpy()
+                rw = torch.from_numpy(_node2vec_walks(indptr, indices, start, walk_length, float(p), float(q)))
+                if device.type == 'cuda':
+                    rw = rw.pin_memory()
+                rw = rw.to(device, non_blocking=True)
+                neg_rw = torch.cat([rw[:, :1], torch.randint(num_nodes, (rw.size(0), walk_length), device=device)], dim=1)
+                pos_rw = _context_windows(rw, context_size)
+                neg_rw = _context_windows(neg_rw, context_size)
+                optimizer.zero_grad(set_to_none=True)
+                loss = _skipgram_loss(embedding.weight, pos_rw, neg_rw)
                 loss.backward()
                 optimizer.step()
-                total_loss += loss.item()
+                total_loss += loss.detach()
+            self.epoch_losses.append(total_loss.item())
 
-        self.embeddings = node2vec.embedding.weight.data.cpu().numpy()
+        self.embeddings = embedding.weight.data.cpu().numpy()
         np.save("./node_embeddings.npy", self.embeddings)
 
     def generate_features_and_labels(self):
@@ -68,27 +138,48 @@ class NodeEmbeddingPredictor:
         patient_indices = [self.node_to_id[pid] for pid in patient_ids]
         gene_indices = [self.node_to_id[gene] for gene in gene_protein_nodes]
 
-        features = []
-        labels = []
+        self.embeddings = self.embeddings.astype(np.float32, copy=False)
+        patient_embeddings = self.embeddings[patient_indices]
+        gene_embeddings = self.embeddings[gene_indices]
+
+        variant_rows = self.variant_patients.get_indexer(patient_ids)
+        variant_cols = self.variant_genes.get_indexer(gene_protein_nodes)
+        if (variant_rows < 0).any() or (variant_cols < 0).any():
+            raise KeyError("Patients or genes missing from the pathogenic variant matrix")
+
+        # Write the (patient, gene) feature rows straight into a memory-mapped .npy instead of building them in RAM
+        # Release maps from a previous call first, Windows cannot reopen a file with w+ while it is still mapped
+        for name in ('features', 'labels'):
+            if isinstance(getattr(self, name, None), np.memmap):
+                getattr(self, name).flush()
+                delattr(self, name)
 
-        for p_idx, patient_id in zip(patient_indices, patient_ids):
-            for g_idx, gene in zip(gene_indices, gene_protein_nodes):
-                feature = np.concatenate([self.embeddings[p_idx], self.embeddings[g_idx]])
-                features.append(feature)
-                label = 1 if self.variant_df.loc[patient_id, gene] != 0 else 0
-                labels.append(label)
+        num_patients, num_genes = len(patient_indices), len(gene_indices)
+        embedding_dim = self.embeddings.shape[1]
+        self.features = np.lib.format.open_memmap(
+            "./features.npy", mode='w+', dtype=np.float32, shape=(num_patients * num_genes, 2 * embedding_dim)
+        )
+        pairs = self.features.reshape(num_patients, num_genes, 2 * embedding_dim)
+        pairs[:, :, :embedding_dim] = patient_embeddings[:, None, :]
+        pairs[:, :, embedding_dim:] = gene_embeddings[None, :, :]
+        del pairs
+        self.features.flush()
 
-        self.features = np.array(features)
-        self.labels = np.array(labels)
-        np.save("./features.npy", self.features)
-        np.save("./labels.npy", self.labels)
+        self.labels = np.lib.format.open_memmap(
+            "./labels.npy", mode='w+', dtype=np.int8, shape=(num_patients * num_genes,)
+        )
+        self.labels[:] = (self.variant_matrix[variant_rows][:, variant_cols].toarray() != 0).ravel()
+        self.labels.flush()
 
     def train_binary_classifier(self):
         X_train, X_test, y_train, y_test = train_test_split(self.features, self.labels, test_size=0.2, random_state=42)
-        classifier = LogisticRegression(max_iter=1000, solver='saga')
-        classifier.fit(X_train, y_train)
+        classifier = make_pipeline(
+            StandardScaler(),
+            LogisticRegression(max_iter=200, solver='lbfgs')
+        )
+        classifier.fit(X_train.astype(np.float32, copy=False), y_train)
         joblib.dump(classifier, "./logistic_regression_model.pkl")
-        y_pred = classifier.predict(X_test)
+        y_pred = classifier.predict(X_test.astype(np.float32, copy=False))
         precision = precision_score(y_test, y_pred)
         recall = recall_score(y_test, y_pred)
         f1 = f1_score(y_test, y_pred)
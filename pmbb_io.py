@@ -0,0 +1,76 @@
+import hashlib
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+from loaders import atomic_write
+
+
+# Filter a single PMBB file by the sampled patient IDs into output_dir
+# Runs in a worker process, so a failure is returned as a message for the parent to report
+def filter_pmbb_file(file_path, sampled_ids, output_dir):
+    try:
+        data = pd.read_csv(file_path, sep='\t', low_memory=False)
+        if 'PMBB_ID' in data.columns:
+            filtered_data = data[data['PMBB_ID'].isin(sampled_ids)]
+            filtered_data.to_csv(os.path.join(output_dir, os.path.basename(file_path)), sep='\t', index=False)
+    except Exception as e:
+        return repr(e)
+    return None
+
+
+# Read a tab-separated PMBB count matrix (ICD-9/ICD-10/PheCode) with the multi-threaded Arrow CSV reader
+# PMBB_ID is pinned to an Arrow-backed string, the code columns are plain numeric counts
+def read_count_matrix(file_path: str, columns: list = None) -> pd.DataFrame:
+    table = pv.read_csv(
+        file_path,
+        parse_options=pv.ParseOptions(delimiter='\t'),
+        convert_options=pv.ConvertOptions(
+            column_types={'PMBB_ID': pa.string()},
+            strings_can_be_null=True,
+            include_columns=columns or []
+        )
+    )
+    return table.to_pandas(types_mapper={pa.string(): pd.StringDtype('pyarrow')}.get)
+
+
+# Convert a PMBB count matrix to a Parquet copy in cache_dir and return its path
+# The copy is keyed on the absolute source path and tagged with the source size and mtime, any mismatch rebuilds it
+def cache_matrix_as_parquet(file_path: str, cache_dir: str) -> str:
+    file_path = os.path.abspath(file_path)
+    path_key = hashlib.sha1(file_path.encode('utf-8')).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f"{os.path.basename(file_path)}.{path_key}.parquet")
+    stat = os.stat(file_path)
+    source = {
+        b'source_path': file_path.encode('utf-8'),
+        b'source_size': str(stat.st_size).encode(),
+        b'source_mtime_ns': str(stat.st_mtime_ns).encode()
+    }
+    if os.path.exists(cache_path):
+        try:
+            metadata = pq.read_schema(cache_path).metadata or {}
+            if all(metadata.get(key) == value for key, value in source.items()):
+                return cache_path
+        except (OSError, pa.ArrowException):
+            pass
+
+    os.makedirs(cache_dir, exist_ok=True)
+    table = pa.Table.from_pandas(read_count_matrix(file_path), preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **source})
+    atomic_write(cache_path, lambda f: pq.write_table(table, f))
+    return cache_path
+
+
+# Read a PMBB count matrix, optionally only some columns, through its Parquet copy when a cache_dir is given
+def read_count_matrix_cached(file_path: str, cache_dir: str = None, columns: list = None) -> pd.DataFrame:
+    if cache_dir is None:
+        return read_count_matrix(file_path, columns=columns)
+    return pd.read_parquet(cache_matrix_as_parquet(file_path, cache_dir), columns=columns)
+
+
+# Column names of a PMBB count matrix, from the Parquet schema when a cache_dir is given, else from the header line
+def read_matrix_columns(file_path: str, cache_dir: str = None) -> list:
+    if cache_dir is None:
+        return pd.read_csv(file_path, sep='\t', nrows=0).columns.tolist()
+    return pq.read_schema(cache_matrix_as_parquet(file_path, cache_dir)).names
@@ -1,13 +1,20 @@
 import igraph as ig
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 from glob import glob
+from itertools import chain
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import random
 import matplotlib.pyplot as plt
 import plotly.graph_objs as go
 import networkx as nx
 import icd10
 from sentence_transformers import SentenceTransformer
+from loaders import downcast_counts
+from pmbb_io import filter_pmbb_file, read_count_matrix, read_count_matrix_cached, read_matrix_columns
 
 
 # Load nodes from PrimeKG.
@@ -49,19 +56,23 @@ def build_graph(nodes: pd.DataFrame, edges: pd.DataFrame) -> ig.Graph:
 
 # Get nodes within given distance from the start_nodes in the graph
 def get_nodes_within_distance(g: ig.Graph, start_nodes: list, max_distance: int) -> set:
-    distances = g.shortest_paths(source=start_nodes, target=None)
-    nodes_to_keep = set()
-    for dist_list in distances:
-        for idx, d in enumerate(dist_list):
-            if d <= max_distance and d != float('inf'):
-                nodes_to_keep.add(idx)
-    return nodes_to_keep
+    neighborhoods = g.neighborhood(vertices=start_nodes, order=max_distance, mode='out')
+    return set(chain.from_iterable(neighborhoods))
 
 
 # Subset the graph to given set of nodes_to_keep
 def subset_graph(nodes: pd.DataFrame, edges: pd.DataFrame, nodes_to_keep: set) -> (pd.DataFrame, pd.DataFrame):
-    sub_nodes = nodes[nodes['node_index'].isin(nodes_to_keep)]
-    sub_edges = edges[(edges['x_index'].isin(nodes_to_keep)) & (edges['y_index'].isin(nodes_to_keep))]
+    node_index = nodes['node_index'].to_numpy()
+    x_index = edges['x_index'].to_numpy()
+    y_index = edges['y_index'].to_numpy()
+
+    # Boolean lookup table over node ids, so membership is a single array gather
+    size = max([max(nodes_to_keep, default=-1)] + [ids.max() for ids in (node_index, x_index, y_index) if len(ids)]) + 1
+    keep = np.zeros(size, dtype=bool)
+    keep[list(nodes_to_keep)] = True
+
+    sub_nodes = nodes[keep[node_index]]
+    sub_edges = edges[keep[x_index] & keep[y_index]]
     return sub_nodes, sub_edges
 
 
@@ -73,36 +84,44 @@ def save_subgraph(sub_nodes: pd.DataFrame, sub_edges: pd.DataFrame, out_dir: str
     sub_edges.to_csv(os.path.join(out_dir, "subgraph_edges.csv"), index=False)
 
 
-# Create a new edge in the dataframe
+EDGE_COLUMNS = ['relation', 'display_relation', 'x_id', 'x_type', 'x_name', 'x_source', 'y_id', 'y_type', 'y_name', 'y_source']
+
+
+# Create new edges in the dataframe from a list of dicts keyed by EDGE_COLUMNS
+def create_new_edges(records: list) -> pd.DataFrame:
+    return pd.DataFrame.from_records(records, columns=EDGE_COLUMNS)
+
+
+# Create a new edge in the dataframe (legacy single-edge wrapper, prefer create_new_edges when adding many edges)
 def create_new_edge(x_id: str, x_type: str, x_name: str, x_source: str, y_id: str, y_type: str, y_name: str, y_source: str, relation: str, display_relation: str) -> pd.DataFrame:
-    data = {
-        'relation': [relation],
-        'display_relation': [display_relation],
-        'x_id': [x_id],
-        'x_type': [x_type],
-        'x_name': [x_name],
-        'x_source': [x_source],
-        'y_id': [y_id],
-        'y_type': [y_type],
-        'y_name': [y_name],
-        'y_source': [y_source]
-    }
-    return pd.DataFrame(data)
+    return create_new_edges([{
+        'relation': relation,
+        'display_relation': display_relation,
+        'x_id': x_id,
+        'x_type': x_type,
+        'x_name': x_name,
+        'x_source': x_source,
+        'y_id': y_id,
+        'y_type': y_type,
+        'y_name': y_name,
+        'y_source': y_source
+    }])
 
 
 # Filter PMBB datasets by patients with non-zero value in given ICD10 code, excludes Q prefix by default
-def filter_pmbb_by_icd10(icd10_code, pmbb_dir, output_dir, num_patients=500, seed=None, exclude_prefix='Q'):
+def filter_pmbb_by_icd10(icd10_code, pmbb_dir, output_dir, num_patients=500, seed=None, exclude_prefix='Q', num_workers=4, cache_dir=None):
     if seed is not None:
         random.seed(seed)
 
     os.makedirs(output_dir, exist_ok=True)
     icd10_file = os.path.join(pmbb_dir, 'PMBB-Release-2020-2.3_phenotype_icd-10-matrix.txt')
-    icd10_df = pd.read_csv(icd10_file, sep='\t', low_memory=False)
-    icd10_df.fillna(0, inplace=True)  # Replace NaNs with 0
 
     # Exclude ICD codes starting with Q
-    icd10_columns = [col for col in icd10_df.columns if col != 'PMBB_ID' and not col.startswith(exclude_prefix)]
+    icd10_columns = [col for col in read_matrix_columns(icd10_file, cache_dir) if col != 'PMBB_ID' and not col.startswith(exclude_prefix)]
     if icd10_code in icd10_columns:
+        # Only the ID and the requested code column are needed here
+        icd10_df = read_count_matrix_cached(icd10_file, cache_dir, columns=['PMBB_ID', icd10_code])
+        icd10_df = downcast_counts(icd10_df)  # Replace NaNs with 0
         selected_patients = icd10_df[icd10_df[icd10_code] > 0]['PMBB_ID'].unique().tolist()
     else:
         selected_patients = []
@@ -116,24 +135,15 @@ def filter_pmbb_by_icd10(icd10_code, pmbb_dir, output_dir, num_patients=500, see
     sampled_ids_file = os.path.join(output_dir, 'sampled_patient_ids.csv')
     pd.DataFrame(sampled_ids, columns=['PMBB_ID']).to_csv(sampled_ids_file, index=False)
 
-    # Filter all datasets using sampled patient IDs
-    files = glob(os.path.join(pmbb_dir, '*'))
-    unmatched_counts = {}
-
-    for file_path in files:
-        if os.path.isfile(file_path):
-            file_name = os.path.basename(file_path)
-            try:
-                data = pd.read_csv(file_path, sep='\t', low_memory=False)
-                if 'PMBB_ID' in data.columns:
-                    filtered_data = data[data['PMBB_ID'].isin(sampled_ids)]
-                    if filtered_data.empty:
-                        unmatched_counts[file_name] = len(sampled_ids)
-                    else:
-                        unmatched_counts[file_name] = len(sampled_ids) - len(filtered_data)
-                    filtered_data.to_csv(os.path.join(output_dir, file_name), sep='\t', index=False)
-            except Exception as e:
-                print(f"Error filtering: {file_name}: {e}")
+    # Filter all datasets using sampled patient IDs, one file per worker process
+    # The hash-backed Index is built once and shipped to every worker
+    files = [file_path for file_path in glob(os.path.join(pmbb_dir, '*')) if os.path.isfile(file_path)]
+    filter_file = partial(filter_pmbb_file, sampled_ids=pd.Index(sampled_ids), output_dir=output_dir)
+    # Each worker parses a whole PMBB file, so keep the pool small to bound peak memory
+    with ProcessPoolExecutor(max_workers=max(1, min(len(files), num_workers))) as executor:
+        for file_path, error in zip(files, executor.map(filter_file, files)):
+            if error is not None:
+                print(f"Error filtering: {os.path.basename(file_path)}: {error}")
 
     return sampled_ids_file
 
@@ -154,48 +164,47 @@ def filter_dataset_by_ids(dataset_path, patient_ids, output_path):
 
 
 def get_non_zero_icd10_codes(icd10_file_path, selected_patient_ids, exclude_prefix='Q') -> dict:
-    icd10_data = pd.read_csv(icd10_file_path, sep='\t', low_memory=False)
-    icd10_data.fillna(0, inplace=True)  # Replace NaNs with 0
+    icd10_data = read_count_matrix(icd10_file_path)
+    icd10_data = downcast_counts(icd10_data)  # Replace NaNs with 0
 
     # Identify ICD-10 code column (excluding 'Q' codes
     icd10_columns = [col for col in icd10_data.columns if col != 'PMBB_ID' and not col.startswith(exclude_prefix)]
 
-    # Filter data for selected patients
-    filtered_data = icd10_data[icd10_data['PMBB_ID'].isin(selected_patient_ids)]
+    # One row per selected patient (first occurrence), patients missing from the file get an all-NaN row
+    patient_rows = icd10_data.drop_duplicates(subset='PMBB_ID').set_index('PMBB_ID').reindex(selected_patient_ids)
+    non_zero = sp.csr_matrix(patient_rows[icd10_columns].to_numpy() > 0)
 
-    patient_icd_mapping = {}
-    for patient_id in selected_patient_ids:
-        if patient_id in filtered_data['PMBB_ID'].values:
-            patient_row = filtered_data[filtered_data['PMBB_ID'] == patient_id].iloc[0]
-            # Get ICD-10 codes with non-zero entries
-            non_zero_icds = patient_row[icd10_columns][patient_row[icd10_columns] > 0].index.tolist()
-            patient_icd_mapping[patient_id] = list(set(non_zero_icds))  # Remove duplicates
-        else:
-            patient_icd_mapping[patient_id] = []
+    # Get ICD-10 codes with non-zero entries, split per patient row
+    codes = np.asarray(icd10_columns, dtype=object)[non_zero.indices]
+    patient_codes = np.split(codes, non_zero.indptr[1:-1])
 
-    return patient_icd_mapping
+    return {patient_id: icds.tolist() for patient_id, icds in zip(selected_patient_ids, patient_codes)}
+
+
+# Memoized icd10 lookup, so repeated codes across patients are only resolved once
+@lru_cache(maxsize=None)
+def _icd_description(code):
+    icd = icd10.find(code)
+    return icd.description if icd else None
 
 
 def get_icd_descriptions(codes):
-    descriptions = []
-    for code in codes:
-        icd = icd10.find(code)
-        if icd:
-            descriptions.append({
-                "icd_code": code,
-                "description": icd.description
-            })
-    return pd.DataFrame(descriptions)
+    descriptions = [
+        (code, description) for code in codes
+        if (description := _icd_description(code)) is not None
+    ]
+    return pd.DataFrame.from_records(descriptions, columns=["icd_code", "description"])
 
 
 def sort_icd_codes(icd_codes):
-    icd9 = sorted([code for code in icd_codes if '.' in code and code[0].isdigit() and int(code.split('.')[0]) < 10])
-    icd10 = sorted([code for code in icd_codes if code not in icd9])
-    return icd9 + icd10
+    codes = pd.Series(list(icd_codes), dtype=object)
+    prefix = pd.to_numeric(codes.str.split('.').str[0], errors='coerce')
+    is_icd9 = codes.str.contains('.', regex=False, na=False) & codes.str.match(r'\d', na=False) & (prefix < 10)
+    return codes[is_icd9].sort_values().tolist() + codes[~is_icd9].sort_values().tolist()
 
 
-def process_matrix_file(file_path, patient_ids):
-    data = pd.read_csv(file_path, sep='\t', low_memory=False)
+def process_matrix_file(file_path, patient_ids, cache_dir=None):
+    data = read_count_matrix_cached(file_path, cache_dir)
     filtered_data = data[data['PMBB_ID'].isin(patient_ids)]
     return filtered_data.set_index('PMBB_ID').to_dict(orient='index')
 
@@ -205,8 +214,9 @@ def process_phenotype_file(file_path, patient_ids):
     return data[data['PMBB_ID'].isin(patient_ids)]
 
 
-def extract_patient_data(pmbb_dir, selected_patient_ids):
+def extract_patient_data(pmbb_dir, selected_patient_ids, cache_dir=None):
     patient_data = {}
+    selected_patient_ids = pd.Index(selected_patient_ids)
 
     matrix_files = [
         "PMBB-Release-2020-2.3_phenotype_icd-9-matrix.txt",
@@ -215,7 +225,7 @@ def extract_patient_data(pmbb_dir, selected_patient_ids):
     ]
     for matrix_file in matrix_files:
         file_path = os.path.join(pmbb_dir, matrix_file)
-        observations = process_matrix_file(file_path, selected_patient_ids)
+        observations = process_matrix_file(file_path, selected_patient_ids, cache_dir)
         patient_data[matrix_file] = observations
 
     phenotype_files = [
@@ -235,10 +245,8 @@ def combine_patient_data(patient_data):
     combined_data = {}
     for file_name, data in patient_data.items():
         if isinstance(data, pd.DataFrame):
-            for patient_id in data['PMBB_ID'].unique():
-                if patient_id not in combined_data:
-                    combined_data[patient_id] = {}
-                combined_data[patient_id][file_name] = data[data['PMBB_ID'] == patient_id].to_dict(orient='records')
+            for patient_id, patient_rows in data.groupby('PMBB_ID', sort=False):
+                combined_data.setdefault(patient_id, {})[file_name] = patient_rows.to_dict(orient='records')
         elif isinstance(data, dict):
             for patient_id, observations in data.items():
                 if patient_id not in combined_data: